@@ -1,3 +1,8 @@
+import asyncio
+import functools
+import hashlib
+import mmap
+import orjson
 import os
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -6,9 +11,9 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from twilio.rest import Client
 from duckduckgo_search import DDGS
-import requests
 from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
+from knowledge_index import KnowledgeIndex
 
 # These variables will be populated from .env by main.py
 TWILIO_ACCOUNT_SID = "" 
@@ -16,6 +21,9 @@ TWILIO_AUTH_TOKEN = ""
 TWILIO_PHONE_NUMBER = ""
 SLACK_BOT_TOKEN = ""
 GEMINI_API_KEY = ""
+GEMINI_API_URL = ""
+GEMINI_STREAM_URL = ""
+GEMINI_CLIENT = None  # Shared httpx.AsyncClient, set by main.py
 
 # Get the absolute path of the directory where this agents.py file is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -38,68 +46,140 @@ class SlackAgent:
         except SlackApiError as e:
             raise Exception(f"Error posting to Slack: {e.response['error']}")
 
+def _knowledge_files(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith(".txt"))
+
+@functools.lru_cache(maxsize=1)
+def _load_knowledge(directory, mtime_digest):
+    # mtime_digest is only part of the key: a changed file invalidates the cache
+    parts = []
+    for filename in _knowledge_files(directory):
+        path = os.path.join(directory, filename)
+        with open(path, 'rb') as f:
+            if os.path.getsize(path) > 1024 * 1024:
+                # mmap large files instead of pulling them through the read buffer
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    parts.append(mm[:].decode('utf-8'))
+            else:
+                parts.append(f.read().decode('utf-8'))
+    return "\n\n".join(parts)
+
 class KnowledgeAgent:
     def __init__(self, directory="knowledge_base"):
         self.directory = os.path.join(BASE_DIR, directory)
+        self._digest = ""
         self.knowledge = self._load_knowledge()
+        # Retrieval index: queries send only the top-k relevant chunks to
+        # Gemini instead of the whole knowledge base
+        self.index = KnowledgeIndex()
+        if self.knowledge:
+            self.index.build(self.knowledge, self._digest)
     def _load_knowledge(self):
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
             return ""
-        full_text = ""
-        for filename in os.listdir(self.directory):
-            if filename.endswith(".txt"):
-                with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as f:
-                    full_text += f.read() + "\n\n"
-        return full_text
-    async def run(self, query: str) -> str:
+        # blake2b, not hash(): the digest is persisted with the vector index
+        # and string hashing is salted per process
+        entries = tuple(
+            (f, os.path.getmtime(os.path.join(self.directory, f))) for f in _knowledge_files(self.directory)
+        )
+        self._digest = hashlib.blake2b(repr(entries).encode(), digest_size=16).hexdigest()
+        return _load_knowledge(self.directory, self._digest)
+    async def run(self, query: str, on_delta=None) -> str:
         if not self.knowledge:
             return "Knowledge base is empty. Add .txt files to the 'knowledge_base' directory."
-        prompt_template = "Context: {context}\n\nQuestion: {question}\n\nAnswer based only on the context:"
-        final_prompt = prompt_template.format(context=self.knowledge, question=query)
+        # Retrieve the most relevant chunks; fall back to the full KB if the
+        # index is unavailable. Embedding is CPU-bound, so keep it off the loop.
+        chunks = await asyncio.to_thread(self.index.query, query)
+        context = "\n\n".join(chunks) if chunks else self.knowledge
+        # Assemble with join so the (potentially large) knowledge text is not
+        # copied through a format scan
+        final_prompt = "".join(("Context: ", context, "\n\nQuestion: ", query, "\n\nAnswer based only on the context:"))
         headers = {"Content-Type": "application/json"}
         payload = {"contents": [{"parts": [{"text": final_prompt}]}]}
-        gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
         try:
-            response = requests.post(gemini_url, headers=headers, json=payload, timeout=60)
+            if on_delta is not None:
+                # Stream the answer token-by-token so the caller can surface
+                # text as it arrives instead of waiting for the full response
+                parts = []
+                async with GEMINI_CLIENT.stream("POST", GEMINI_STREAM_URL, headers=headers, json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        chunk = orjson.loads(line[len("data: "):])
+                        try:
+                            delta = chunk['candidates'][0]['content']['parts'][0]['text']
+                        except (KeyError, IndexError):
+                            continue
+                        parts.append(delta)
+                        await on_delta(delta)
+                return "".join(parts).strip()
+            response = await GEMINI_CLIENT.post(GEMINI_API_URL, headers=headers, json=payload)
             response.raise_for_status()
             return response.json()['candidates'][0]['content']['parts'][0]['text'].strip()
         except Exception as e:
             return f"Error consulting knowledge base: {e}"
 
 class SearchAgent:
+    def __init__(self):
+        # One long-lived session: the context-manager-per-query version tore
+        # down and rebuilt the underlying HTTP session on every search
+        self.ddgs = DDGS()
     async def run(self, query: str) -> str:
         try:
-            with DDGS() as ddgs:
-                results = [r for r in ddgs.text(query, max_results=3)]
-                if not results: return "No results found."
-                return "\n".join([f"{r['title']}: {r['body']}" for r in results])
+            # The search client is synchronous; keep it off the event loop
+            results = await asyncio.to_thread(lambda: list(self.ddgs.text(query, max_results=3)))
+            if not results: return "No results found."
+            return "\n".join([f"{r['title']}: {r['body']}" for r in results])
         except Exception as e:
             return f"Error during search: {e}"
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 class CalendarAgent:
-    def __init__(self): self.creds = self._get_credentials()
+    def __init__(self):
+        self.creds = self._get_credentials()
+        self._service = None
+    def _get_service(self):
+        # Build the service once; rebuilding per call re-fetches the discovery
+        # document and re-creates the underlying HTTP session
+        if self._service is None:
+            self._service = build("calendar", "v3", credentials=self.creds)
+        return self._service
+    @classmethod
+    def authorize(cls):
+        """Run the interactive OAuth flow and save token.json.
+
+        This spawns a browser and blocks, so it lives in the one-time
+        'python authorize.py' step rather than anywhere the server runs.
+        """
+        if not os.path.exists(CREDENTIALS_PATH):
+            raise FileNotFoundError(f"FATAL: credentials.json not found at the expected path: {CREDENTIALS_PATH}. Please ensure the file exists and is named correctly.")
+        flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+        creds = flow.run_local_server(port=0)
+        with open(TOKEN_PATH, "w") as token:
+            token.write(creds.to_json())
+        return creds
     def _get_credentials(self):
+        # Non-interactive: load the saved token, refresh it if possible, and
+        # fail with a clear message instead of launching the browser flow
         creds = None
         if os.path.exists(TOKEN_PATH):
             creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                if not os.path.exists(CREDENTIALS_PATH):
-                    raise FileNotFoundError(f"FATAL: credentials.json not found at the expected path: {CREDENTIALS_PATH}. Please ensure the file exists and is named correctly.")
-                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
-                creds = flow.run_local_server(port=0)
+        if creds and not creds.valid and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
             with open(TOKEN_PATH, "w") as token:
                 token.write(creds.to_json())
+        if not creds or not creds.valid:
+            raise RuntimeError("Google Calendar token missing or expired. Run 'python authorize.py' once to authorize.")
         return creds
     async def run(self, event_details: dict):
         try:
-            service = build("calendar", "v3", credentials=self.creds)
+            # Both the first service build (discovery fetch) and the insert
+            # are blocking network calls; keep them off the event loop
+            service = await asyncio.to_thread(self._get_service)
             event = {"summary": event_details.get("title"), "start": {"dateTime": event_details["start_time"], "timeZone": "Asia/Kolkata"}, "end": {"dateTime": event_details["end_time"], "timeZone": "Asia/Kolkata"}}
-            event = service.events().insert(calendarId="primary", body=event).execute()
+            event = await asyncio.to_thread(service.events().insert(calendarId="primary", body=event).execute)
             return event.get('htmlLink')
         except HttpError as error:
             raise Exception(f"Google Calendar API Error: {error}")
@@ -111,12 +191,13 @@ class CommunicationAgent:
             print("WARNING: Twilio credentials not set in .env file. CommunicationAgent will not work.")
         else:
             self.client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-    def send_sms(self, recipient: str, message: str) -> str:
+    async def send_sms(self, recipient: str, message: str) -> str:
         if not self.client: raise Exception("Twilio client not initialized.")
-        message = self.client.messages.create(body=message, from_=TWILIO_PHONE_NUMBER, to=recipient)
-        return message.sid
-    def make_call(self, recipient: str, message: str) -> str:
+        # The Twilio REST client is synchronous; run it off the event loop
+        sms = await asyncio.to_thread(self.client.messages.create, body=message, from_=TWILIO_PHONE_NUMBER, to=recipient)
+        return sms.sid
+    async def make_call(self, recipient: str, message: str) -> str:
         if not self.client: raise Exception("Twilio client not initialized.")
         twiml_message = f'<Response><Say>{message}</Say></Response>'
-        call = self.client.calls.create(twiml=twiml_message, to=recipient, from_=TWILIO_PHONE_NUMBER)
+        call = await asyncio.to_thread(self.client.calls.create, twiml=twiml_message, to=recipient, from_=TWILIO_PHONE_NUMBER)
         return call.sid
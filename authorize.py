@@ -0,0 +1,17 @@
+"""One-time Google Calendar authorization.
+
+Runs the interactive OAuth flow (opens a browser) and saves token.json next
+to this file. The server itself never runs this flow: it only loads the saved
+token, so the event loop can't be frozen by a surprise browser prompt.
+
+Usage: python authorize.py
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import agents
+
+if __name__ == "__main__":
+    agents.CalendarAgent.authorize()
+    print(f"Authorization complete. Token saved to {agents.TOKEN_PATH}")
@@ -0,0 +1,81 @@
+import os
+
+from semantic_cache import _DEPS_AVAILABLE, embed_to_blob, open_vec_db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, "knowledge_index.db")
+
+# ~500 tokens of context per chunk
+CHUNK_CHARS = 2000
+
+
+def _chunk_text(text: str, chunk_chars: int = CHUNK_CHARS):
+    """Split text into ~chunk_chars pieces on paragraph boundaries."""
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and current_len + len(paragraph) > chunk_chars:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_len = 0
+        current.append(paragraph)
+        current_len += len(paragraph)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class KnowledgeIndex:
+    """Vector index over the knowledge base for top-k retrieval.
+
+    Knowledge files are chunked, embedded once and persisted in sqlite-vec,
+    so queries pull only the most relevant chunks instead of shipping the
+    entire KB to Gemini on every question. The index is keyed on a digest of
+    file mtimes and rebuilt only when a file changes.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, top_k=5):
+        if not _DEPS_AVAILABLE:
+            print("WARNING: sqlite-vec / sentence-transformers not installed. Knowledge retrieval falls back to the full KB.")
+            self.enabled = False
+            return
+        try:
+            self.conn = open_vec_db(db_path)
+        except RuntimeError as e:
+            print(f"WARNING: {e}. Knowledge retrieval falls back to the full KB.")
+            self.enabled = False
+            return
+        self.enabled = True
+        self.top_k = top_k
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (embedding BLOB, content TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def build(self, full_text: str, digest: str):
+        """(Re)index the knowledge text unless it is already indexed."""
+        if not self.enabled:
+            return
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'digest'").fetchone()
+        if row is not None and row[0] == digest:
+            return
+        self.conn.execute("DELETE FROM chunks")
+        for chunk in _chunk_text(full_text):
+            self.conn.execute("INSERT INTO chunks (embedding, content) VALUES (?, ?)", (embed_to_blob(chunk), chunk))
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('digest', ?)", (digest,))
+        self.conn.commit()
+
+    def query(self, text: str):
+        """Return the top-k most relevant chunks for a query, best first."""
+        if not self.enabled:
+            return None
+        rows = self.conn.execute(
+            "SELECT content, vec_distance_cosine(embedding, ?) AS dist FROM chunks ORDER BY dist LIMIT ?",
+            (embed_to_blob(text), self.top_k),
+        ).fetchall()
+        if not rows:
+            return None
+        return [content for content, _ in rows]
@@ -1,13 +1,18 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import msgspec
 import asyncio
-import json
 import os
 from dotenv import load_dotenv
 
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -17,7 +22,7 @@ import orchestrator
 
 # Set credentials from environment variables at startup
 # This is the correct way to pass secrets to your modules
-orchestrator.GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
+orchestrator.configure(os.getenv('GEMINI_API_KEY', ''))
 os.environ['GEMINI_API_KEY_HOLDER'] = orchestrator.GEMINI_API_KEY
 
 agents.TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID', '')
@@ -25,13 +30,46 @@ agents.TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN', '')
 agents.TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER', '')
 agents.SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN', '')
 agents.GEMINI_API_KEY = orchestrator.GEMINI_API_KEY
+agents.GEMINI_API_URL = orchestrator.GEMINI_API_URL
+agents.GEMINI_STREAM_URL = orchestrator.GEMINI_STREAM_URL
+agents.GEMINI_CLIENT = orchestrator._gemini_client
 
 # Check if essential keys are loaded
 if not orchestrator.GEMINI_API_KEY:
     print("FATAL ERROR: GEMINI_API_KEY not found in .env file. The application will not work.")
     print("Please create a .env file and add your GEMINI_API_KEY.")
 
-app = FastAPI()
+def build_agent_pool():
+    pool = {
+        "communication": agents.CommunicationAgent(),
+        "search": agents.SearchAgent(),
+        "knowledge": agents.KnowledgeAgent(),
+        "slack": agents.SlackAgent(),
+    }
+    try:
+        pool["calendar"] = agents.CalendarAgent()
+    except Exception as e:
+        print(f"WARNING: CalendarAgent could not be initialized at startup ({e}). It will be created on first use.")
+    return pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build each agent once and share them across tasks; per-task construction
+    # costs credential I/O and knowledge-base reads on every POST /api/tasks.
+    # Run it in a thread: token loading and knowledge-base scans are blocking.
+    app.state.agent_pool = await asyncio.to_thread(build_agent_pool)
+    subscriber_task = None
+    if manager.redis is not None:
+        subscriber_task = asyncio.create_task(manager.run_subscriber())
+    yield
+    if subscriber_task is not None:
+        subscriber_task.cancel()
+    if manager.redis is not None:
+        await manager.redis.aclose()
+    # Close keep-alive connections cleanly on shutdown
+    await orchestrator._gemini_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,28 +79,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+REDIS_URL = os.getenv('REDIS_URL', '')
+REDIS_CHANNEL = "task_updates"
+
 class ConnectionManager:
+    """Fans task updates out to websocket clients.
+
+    With REDIS_URL set, broadcasts travel through a Redis pub/sub channel so
+    every uvicorn worker (each with its own local connection list) delivers
+    the message to its clients. Without Redis it degrades to in-process
+    fan-out, which is only correct with a single worker.
+    """
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
+        if REDIS_URL and aioredis is not None:
+            self.redis = aioredis.from_url(REDIS_URL)
+        else:
+            self.redis = None
+            if REDIS_URL:
+                print("WARNING: REDIS_URL is set but the 'redis' package is not installed. Falling back to in-process broadcast.")
+            else:
+                print("WARNING: REDIS_URL not set. Websocket broadcast is in-process only; run with a single uvicorn worker.")
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # discard is O(1) and safe if the socket was already pruned
+        self.active_connections.discard(websocket)
+    async def broadcast(self, message):
+        # message may be str or pre-encoded bytes (orjson.dumps output)
+        if self.redis is not None:
+            await self.redis.publish(REDIS_CHANNEL, message)
+        else:
+            await self._send_local(message)
+    async def _send_local(self, message):
+        if not self.active_connections:
+            return
+        # Encode once and fan out concurrently so one slow client cannot
+        # hold up the others
+        data = message.encode() if isinstance(message, str) else message
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_bytes(data) for connection in connections),
+            return_exceptions=True,
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.disconnect(connection)
+    async def run_subscriber(self):
+        """Forward messages published on the Redis channel to local clients."""
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(REDIS_CHANNEL)
+        async for item in pubsub.listen():
+            if item["type"] == "message":
+                await self._send_local(item["data"])
 
 manager = ConnectionManager()
 
-class TaskRequest(BaseModel):
+class TaskRequest(msgspec.Struct):
     prompt: str
 
 @app.post("/api/tasks")
-async def create_task(task_request: TaskRequest):
+async def create_task(request: Request):
+    # msgspec decodes and validates the body in C, several times faster
+    # than a Pydantic model
+    try:
+        task_request = msgspec.json.decode(await request.body(), type=TaskRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     print(f"Received task: {task_request.prompt}")
     task_id = "task_12345"
-    orch_instance = orchestrator.TaskOrchestrator(task_id, task_request.prompt, manager)
+    orch_instance = orchestrator.TaskOrchestrator(task_id, task_request.prompt, manager, agent_pool=app.state.agent_pool)
     asyncio.create_task(orch_instance.execute_plan())
     return {"status": "Task received", "task_id": task_id}
 
@@ -82,4 +169,9 @@ app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 @app.get("/")
 async def read_root():
-    return FileResponse('static/index.html')
\ No newline at end of file
+    return FileResponse('static/index.html')
+
+if __name__ == "__main__":
+    import uvicorn
+    # permessage-deflate shrinks the repetitive JSON log frames several-fold
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, ws_per_message_deflate=True)
\ No newline at end of file
@@ -1,15 +1,91 @@
 import asyncio
-import json
-import requests
+import hashlib
+import random
+import string
+import httpx
+import msgspec
+import orjson
+import cachetools
 import os
 import agents
 from datetime import datetime
+from typing import Optional
+from semantic_cache import SemanticCache
 
-GEMINI_API_KEY = "" # This will be set by main.py
+GEMINI_MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash"
+GEMINI_API_KEY = "" # Set via configure() from main.py
 GEMINI_API_URL = ""
+GEMINI_STREAM_URL = ""
+
+def configure(api_key: str):
+    """Set the API key and build the request URLs once at startup.
+
+    Rebuilding the URL per task (the old __init__ global mutation) allocated
+    a fresh f-string per task and raced under concurrent initialization.
+    """
+    global GEMINI_API_KEY, GEMINI_API_URL, GEMINI_STREAM_URL
+    GEMINI_API_KEY = api_key
+    GEMINI_API_URL = f"{GEMINI_MODEL_URL}:generateContent?key={api_key}"
+    GEMINI_STREAM_URL = f"{GEMINI_MODEL_URL}:streamGenerateContent?alt=sse&key={api_key}"
+
+# Shared async HTTP client for all Gemini calls. Keep-alive connections avoid
+# paying the TCP+TLS handshake on every planner/parser request, and the async
+# API stops the event loop from blocking for the full timeout window.
+# main.py closes this client on app shutdown.
+_gemini_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+    timeout=60.0,
+    http2=True,
+)
+
+# Semantic cache shared across all tasks. Near-identical prompts (the same
+# request phrased slightly differently) return a cached Gemini response in
+# milliseconds instead of paying the full round-trip.
+_semantic_cache = SemanticCache()
+
+# Exact-match cache checked before the semantic cache: identical prompts are
+# O(1) hash lookups and skip the embedding step entirely.
+_exact_cache = cachetools.TTLCache(maxsize=4096, ttl=3600)
+_exact_cache_lock = asyncio.Lock()
+
+# Single-flight map: concurrent requests for the same prompt share one
+# in-flight HTTP call instead of each hitting Gemini.
+_inflight: dict = {}
+
+# Local rate limit: at most 8 Gemini calls in flight per worker, so a busy
+# plan doesn't burst into 429s.
+_gemini_semaphore = asyncio.Semaphore(8)
+
+class PlanStep(msgspec.Struct):
+    """Schema the planner's steps are validated against (in C, via msgspec)."""
+    agent: str
+    action: str
+    status: str = "pending"
+    parsed_args: Optional[dict] = None
+
+class PromptTemplate:
+    """A prompt template parsed once at import time.
+
+    str.format re-scans the full template string on every call, which adds up
+    once prompts carry KB-sized context. This splits the template into literal
+    chunks and placeholder names up front so render() is a single join. The
+    name doubles as the cache namespace for the template's responses.
+    """
+    def __init__(self, name: str, template: str):
+        self.name = name
+        self._segments = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+    def render(self, **values) -> str:
+        parts = []
+        for literal, field in self._segments:
+            if literal:
+                parts.append(literal)
+            if field is not None:
+                parts.append(str(values[field]))
+        return "".join(parts)
 
 # --- ROBUST PROMPTS ---
-PLANNER_PROMPT_TEMPLATE = """
+PLANNER_PROMPT_TEMPLATE = PromptTemplate("planner", """
 You are an expert planning agent. Your job is to create a plan to fulfill a user's request.
 Here are the available agents:
 - "KnowledgeAgent": Use for questions about internal data.
@@ -18,24 +94,30 @@ Here are the available agents:
 - "CommunicationAgent": Can make phone calls or send text messages.
 - "CalendarAgent": Can interact with a user's calendar.
 Based on the user's request, create a JSON array of steps. Each object in the array MUST have an "agent" and an "action" key.
+When the details are already explicit in the request, ALSO include a "parsed_args" object with that agent's arguments:
+- SlackAgent: "channel" (starting with '#') and "message".
+- CalendarAgent: "title", "start_time" and "end_time" in ISO 8601 format (YYYY-MM-DDTHH:MM:SS). The current date is {current_date}; resolve relative times like "tomorrow" from it.
+- CommunicationAgent: "type" ('call' or 'sms'), "recipient" (a phone number in E.164 format) and "message".
+- SearchAgent: "query", a concise web search query.
+Omit "parsed_args" when you are not certain of the exact values.
 User Request: "{user_prompt}"
-"""
-SLACK_PARSER_PROMPT_TEMPLATE = """
+""")
+SLACK_PARSER_PROMPT_TEMPLATE = PromptTemplate("slack_parser", """
 You are a data extraction tool. From the user's text, extract the 'channel' and the 'message'.
 The channel name must start with a '#'. The message is the content to be posted.
 Respond with ONLY a valid JSON object containing "channel" and "message" keys.
 
 Example Text: "Post a message on #general channel in Slack saying 'Hi, I'm Oreo!'"
 Example JSON Output:
-{
+{{
   "channel": "#general",
   "message": "Hi, I'm Oreo!"
-}
+}}
 
 Text: "{action_text}"
 JSON Output:
-"""
-EVENT_PARSER_PROMPT_TEMPLATE = """
+""")
+EVENT_PARSER_PROMPT_TEMPLATE = PromptTemplate("event_parser", """
 You are a data extraction tool. From the user's text, extract event details: 'title', 'start_time', and 'end_time'.
 The start and end times must be in ISO 8601 format (YYYY-MM-DDTHH:MM:SS).
 The current date is {current_date}. Resolve relative times like "tomorrow" based on this date.
@@ -43,70 +125,135 @@ Respond with ONLY a valid JSON object.
 
 Text: "{action_text}"
 JSON Output:
-"""
-COMMUNICATION_PARSER_PROMPT_TEMPLATE = """
+""")
+COMMUNICATION_PARSER_PROMPT_TEMPLATE = PromptTemplate("communication_parser", """
 You are a data extraction tool. From the user's text, extract 'type' ('call' or 'sms'), 'recipient' (a phone number in E.164 format), and 'message'.
 Respond with ONLY a valid JSON object.
 
 Text: "{action_text}"
 JSON Output:
-"""
-SEARCH_QUERY_PARSER_PROMPT_TEMPLATE = """
+""")
+SEARCH_QUERY_PARSER_PROMPT_TEMPLATE = PromptTemplate("search_query_parser", """
 You are a data extraction tool. From the user's text, extract a concise, effective web search query.
 Respond with only the search query as a raw string.
 
 Text: "{action_text}"
 Search Query:
-"""
+""")
 
 class TaskOrchestrator:
-    def __init__(self, task_id: str, prompt: str, ws_manager):
+    def __init__(self, task_id: str, prompt: str, ws_manager, agent_pool=None):
         self.task_id = task_id
         self.prompt = prompt
         self.ws_manager = ws_manager
         self.plan = []
-        self.context = {} 
-        self.calendar_agent = agents.CalendarAgent()
-        self.communication_agent = agents.CommunicationAgent()
-        self.search_agent = agents.SearchAgent()
-        self.knowledge_agent = agents.KnowledgeAgent()
-        self.slack_agent = agents.SlackAgent()
-        
-        global GEMINI_API_URL
-        GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+        self.context = {}
+        # Agents come from the shared pool built at app startup; constructing
+        # them per task costs credential I/O and knowledge-base reads.
+        agent_pool = agent_pool or {}
+        self.calendar_agent = agent_pool.get("calendar")  # created on first use if absent
+        self.communication_agent = agent_pool.get("communication") or agents.CommunicationAgent()
+        self.search_agent = agent_pool.get("search") or agents.SearchAgent()
+        self.knowledge_agent = agent_pool.get("knowledge") or agents.KnowledgeAgent()
+        self.slack_agent = agent_pool.get("slack") or agents.SlackAgent()
 
-    async def _gemini_request(self, prompt_data: dict, parser_template: str, is_json_output: bool = True):
+    @staticmethod
+    async def _post_with_retry(headers: dict, payload: dict):
+        """POST to Gemini, retrying transient failures (429/5xx/transport)
+        with exponential backoff and jitter. Client errors raise immediately."""
+        delay = 0.5
+        for attempt in range(5):
+            try:
+                async with _gemini_semaphore:
+                    response = await _gemini_client.post(GEMINI_API_URL, headers=headers, json=payload)
+                response.raise_for_status()
+                return response
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if attempt == 4 or (status != 429 and status < 500):
+                    raise
+                print(f"Gemini returned {status}, retrying (attempt {attempt + 1}/5)...")
+            except httpx.TransportError as e:
+                if attempt == 4:
+                    raise
+                print(f"Gemini transport error ({e}), retrying (attempt {attempt + 1}/5)...")
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 8.0)
+
+    @staticmethod
+    def _parse_gemini_content(content: str, is_json_output: bool):
+        if is_json_output:
+            return orjson.loads(content.strip().lstrip("```json").rstrip("```").strip())
+        return content.strip()
+
+    async def _gemini_request(self, prompt_data: dict, parser_template: PromptTemplate, is_json_output: bool = True):
         if not GEMINI_API_KEY:
              raise ValueError("GEMINI_API_KEY is not set. Please check your .env file.")
-        
+
         headers = {"Content-Type": "application/json"}
-        final_prompt = parser_template.format(**prompt_data)
+        final_prompt = parser_template.render(**prompt_data)
+        # Namespace cache entries by template so parsers never see each other's responses
+        cache_namespace = parser_template.name
+
+        # Tier 1: exact-match lookup on the rendered prompt
+        exact_key = (hashlib.blake2b(final_prompt.encode(), digest_size=16).digest(), is_json_output)
+        async with _exact_cache_lock:
+            cached = _exact_cache.get(exact_key)
+        if cached is not None:
+            return self._parse_gemini_content(cached, is_json_output)
+
+        # Tier 2: embedding is CPU-bound, so run the lookup off the event loop
+        cached = await asyncio.to_thread(_semantic_cache.get, cache_namespace, final_prompt)
+        if cached is not None:
+            return self._parse_gemini_content(cached, is_json_output)
+
+        # Coalesce concurrent identical prompts onto a single HTTP call
+        inflight_key = exact_key[0]
+        existing = _inflight.get(inflight_key)
+        if existing is not None:
+            content_part = await existing
+            return self._parse_gemini_content(content_part, is_json_output)
+
+        future = asyncio.get_running_loop().create_future()
+        _inflight[inflight_key] = future
+
         payload = {"contents": [{"parts": [{"text": final_prompt}]}]}
-        
+
         try:
-            response = requests.post(GEMINI_API_URL, headers=headers, json=payload, timeout=60)
-            response.raise_for_status()
-            response_json = response.json()
-            
+            response = await self._post_with_retry(headers, payload)
+            response_json = orjson.loads(response.content)
+
             if 'candidates' not in response_json or not response_json['candidates']:
                 raise ValueError("Invalid response from Gemini API: 'candidates' field is missing or empty.")
 
             content_part = response_json['candidates'][0]['content']['parts'][0]['text']
-            
-            if is_json_output:
-                return json.loads(content_part.strip().lstrip("```json").rstrip("```").strip())
-            return content_part.strip()
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err} - {response.text}")
+            result = self._parse_gemini_content(content_part, is_json_output)
+            future.set_result(content_part)
+            async with _exact_cache_lock:
+                _exact_cache[exact_key] = content_part
+            await asyncio.to_thread(_semantic_cache.put, cache_namespace, final_prompt, content_part)
+            return result
+        except httpx.HTTPStatusError as http_err:
+            print(f"HTTP error occurred: {http_err} - {http_err.response.text}")
+            if not future.done():
+                future.set_exception(http_err)
+                # Mark retrieved: with no duplicate waiters, nothing awaits the
+                # future and asyncio would log the exception on GC
+                future.exception()
             raise
         except Exception as e:
             print(f"An unexpected error occurred in _gemini_request: {e}")
+            if not future.done():
+                future.set_exception(e)
+                future.exception()
             raise
+        finally:
+            _inflight.pop(inflight_key, None)
 
     async def execute_plan(self):
         try:
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "PlannerAgent", "message": "Contacting Gemini API to create an execution plan...", "log_type": "info"}))
-            plan_prompt = {"user_prompt": self.prompt}
+            await self.ws_manager.broadcast(orjson.dumps({"t": "log", "a": "PlannerAgent", "m": "Contacting Gemini API to create an execution plan...", "lt": "info"}))
+            plan_prompt = {"user_prompt": self.prompt, "current_date": datetime.now().strftime("%A, %Y-%m-%d")}
             self.plan = await self._gemini_request(plan_prompt, PLANNER_PROMPT_TEMPLATE)
             
             if not isinstance(self.plan, list):
@@ -114,47 +261,63 @@ class TaskOrchestrator:
 
             validated_plan = []
             for step in self.plan:
-                if isinstance(step, dict) and 'agent' in step and 'action' in step:
-                    step['status'] = 'pending'
-                    validated_plan.append(step)
-                else:
+                try:
+                    validated = msgspec.convert(step, type=PlanStep)
+                except msgspec.ValidationError:
                     print(f"WARNING: Skipping invalid step received from AI: {step}")
+                    continue
+                validated_plan.append(msgspec.structs.asdict(validated))
             
             self.plan = validated_plan
             if not self.plan:
                  raise ValueError("The AI planner returned a plan with no valid steps.")
 
-            await self.ws_manager.broadcast(json.dumps({"type": "plan", "steps": self.plan}))
+            await self.ws_manager.broadcast(orjson.dumps({"t": "plan", "s": self.plan}))
 
         except Exception as e:
             error_message = f"Failed to create a valid task plan. Please try rephrasing your command. Error: {e}"
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "System", "message": error_message, "log_type": "error"}))
+            await self.ws_manager.broadcast(orjson.dumps({"t": "log", "a": "System", "m": error_message, "lt": "error"}))
             return
 
+        # Steps whose action has no {context_key} placeholder are independent and
+        # run concurrently; a step that consumes context waits for everything
+        # scheduled before it (its producers) to finish first.
+        pending = []
         for step in self.plan:
-            await asyncio.sleep(1)
-            try:
-                if '{' in step['action'] and '}' in step['action']:
+            needs_context = '{' in step['action'] and '}' in step['action']
+            if needs_context:
+                if pending:
+                    await asyncio.gather(*(self._execute_step(s) for s in pending))
+                    pending = []
+                try:
                     step['action'] = step['action'].format(**self.context)
-            except KeyError as e:
-                print(f"Info: Skipping format for action '{step['action']}' due to missing key: {e}")
-
-            await self._execute_step(step)
+                except KeyError as e:
+                    print(f"Info: Skipping format for action '{step['action']}' due to missing key: {e}")
+                await self._execute_step(step)
+            else:
+                pending.append(step)
+        if pending:
+            await asyncio.gather(*(self._execute_step(s) for s in pending))
 
-        await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "System", "message": "Task automation completed.", "log_type": "success"}))
+        await self.ws_manager.broadcast(orjson.dumps({"t": "log", "a": "System", "m": "Task automation completed.", "lt": "success"}))
 
     async def _execute_step(self, step: dict):
         agent_name = step.get('agent', 'UnknownAgent')
         action = step.get('action', 'No action defined')
 
-        await self.ws_manager.broadcast(json.dumps({"type": "status_update", "step_action": action, "status": "in-progress"}))
-        await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": agent_name, "message": f"Starting: {action}...", "log_type": "info"}))
+        await self.ws_manager.broadcast(orjson.dumps({"t": "status_update", "sa": action, "st": "in-progress"}))
+        await self.ws_manager.broadcast(orjson.dumps({"t": "log", "a": agent_name, "m": f"Starting: {action}...", "lt": "info"}))
 
         execution_result = ""
         step_succeeded = True
         try:
+            # The planner can supply parsed_args directly, saving a parser round-trip
+            parsed_args = step.get('parsed_args') if isinstance(step.get('parsed_args'), dict) else {}
+
             if agent_name == "SlackAgent":
-                slack_details = await self._gemini_request({"action_text": action}, SLACK_PARSER_PROMPT_TEMPLATE)
+                slack_details = parsed_args
+                if not slack_details.get("channel") or not slack_details.get("message"):
+                    slack_details = await self._gemini_request({"action_text": action}, SLACK_PARSER_PROMPT_TEMPLATE)
                 if not slack_details.get("channel") or not slack_details.get("message"):
                     raise ValueError("Could not parse a valid channel and message from the request. The LLM returned invalid data.")
                 message_to_send = slack_details["message"].format(**self.context)
@@ -162,26 +325,39 @@ class TaskOrchestrator:
                 execution_result = f"Message successfully posted to Slack channel {slack_details['channel']}."
 
             elif agent_name == "KnowledgeAgent":
-                answer = await self.knowledge_agent.run(action)
+                async def send_delta(delta):
+                    await self.ws_manager.broadcast(orjson.dumps({"t": "log_delta", "a": agent_name, "d": delta}))
+                answer = await self.knowledge_agent.run(action, on_delta=send_delta)
                 self.context['knowledge_answer'] = answer
                 execution_result = f"Knowledge Base Answer: {answer}"
             elif agent_name == "SearchAgent":
-                query = await self._gemini_request({"action_text": action}, SEARCH_QUERY_PARSER_PROMPT_TEMPLATE, is_json_output=False)
+                query = parsed_args.get("query")
+                if not query:
+                    query = await self._gemini_request({"action_text": action}, SEARCH_QUERY_PARSER_PROMPT_TEMPLATE, is_json_output=False)
                 search_results = await self.search_agent.run(query)
                 self.context['search_result'] = search_results 
                 execution_result = f"Search for '{query}' found: {search_results}"
             elif agent_name == "CalendarAgent":
-                event_details = await self._gemini_request({"action_text": action, "current_date": datetime.now().strftime("%A, %Y-%m-%d")}, EVENT_PARSER_PROMPT_TEMPLATE)
+                if self.calendar_agent is None:
+                    # Not available at startup (e.g. not yet authorized); token
+                    # loading is blocking I/O, and any credential error becomes
+                    # a step failure, not a 500
+                    self.calendar_agent = await asyncio.to_thread(agents.CalendarAgent)
+                event_details = parsed_args
+                if not all(event_details.get(k) for k in ("title", "start_time", "end_time")):
+                    event_details = await self._gemini_request({"action_text": action, "current_date": datetime.now().strftime("%A, %Y-%m-%d")}, EVENT_PARSER_PROMPT_TEMPLATE)
                 event_link = await self.calendar_agent.run(event_details)
                 execution_result = f"Successfully created event. View: {event_link}"
             elif agent_name == "CommunicationAgent":
-                comm_details = await self._gemini_request({"action_text": action}, COMMUNICATION_PARSER_PROMPT_TEMPLATE)
+                comm_details = parsed_args
+                if not all(comm_details.get(k) for k in ("type", "recipient", "message")):
+                    comm_details = await self._gemini_request({"action_text": action}, COMMUNICATION_PARSER_PROMPT_TEMPLATE)
                 message_to_send = comm_details["message"].format(**self.context)
                 if comm_details.get("type") == "sms":
-                    sms_sid = self.communication_agent.send_sms(comm_details["recipient"], message_to_send)
+                    sms_sid = await self.communication_agent.send_sms(comm_details["recipient"], message_to_send)
                     execution_result = f"SMS to {comm_details['recipient']} sent successfully. SID: {sms_sid}"
                 elif comm_details.get("type") == "call":
-                    call_sid = self.communication_agent.make_call(comm_details["recipient"], message_to_send)
+                    call_sid = await self.communication_agent.make_call(comm_details["recipient"], message_to_send)
                     execution_result = f"Call to {comm_details['recipient']} initiated. SID: {call_sid}"
             else:
                 print(f"Executing (Simulated): {agent_name} -> {action}")
@@ -194,5 +370,5 @@ class TaskOrchestrator:
             print(f"Error during execution: {e}")
 
         final_status = "completed" if step_succeeded else "failed"
-        await self.ws_manager.broadcast(json.dumps({"type": "status_update", "step_action": action, "status": final_status}))
-        await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": agent_name, "message": execution_result, "log_type": "info" if step_succeeded else "error"}))
+        await self.ws_manager.broadcast(orjson.dumps({"t": "status_update", "sa": action, "st": final_status}))
+        await self.ws_manager.broadcast(orjson.dumps({"t": "log", "a": agent_name, "m": execution_result, "lt": "info" if step_succeeded else "error"}))
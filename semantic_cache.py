@@ -0,0 +1,95 @@
+import functools
+import os
+import sqlite3
+import struct
+import time
+
+# Optional dependencies: the cache silently degrades to a no-op when they are
+# not installed so the app still runs without the extra ML stack.
+try:
+    import sqlite_vec
+    from sentence_transformers import SentenceTransformer
+    _DEPS_AVAILABLE = True
+except ImportError:
+    _DEPS_AVAILABLE = False
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, "gemini_cache.db")
+
+@functools.lru_cache(maxsize=1)
+def load_embedder():
+    """One embedding model shared by every consumer (cache, knowledge index)."""
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+def embed_to_blob(text: str) -> bytes:
+    vector = load_embedder().encode(text, normalize_embeddings=True)
+    return struct.pack(f"{len(vector)}f", *vector)
+
+def open_vec_db(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    try:
+        # Pythons built without loadable-extension support have no
+        # enable_load_extension at all; surface both that and a failed
+        # extension load as one error the callers can degrade on
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        conn.close()
+        raise RuntimeError(f"sqlite-vec extension unavailable: {e}")
+    return conn
+
+
+class SemanticCache:
+    """Similarity cache for Gemini responses.
+
+    Prompts are embedded with a small local model and stored in sqlite with
+    sqlite-vec for cosine lookups. Entries are namespaced per prompt template
+    so e.g. a Slack-parser response can never be returned for a Calendar-parser
+    query. A lookup is a hit when the top-1 cosine similarity is >= threshold,
+    so rephrasings like "schedule a meeting tomorrow at 3pm" vs "set up a 3pm
+    meeting for tomorrow" skip the Gemini round-trip entirely.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, threshold=0.95, ttl_seconds=24 * 3600):
+        if not _DEPS_AVAILABLE:
+            print("WARNING: sqlite-vec / sentence-transformers not installed. Semantic caching is disabled.")
+            self.enabled = False
+            return
+        try:
+            self.conn = open_vec_db(db_path)
+        except RuntimeError as e:
+            print(f"WARNING: {e}. Semantic caching is disabled.")
+            self.enabled = False
+            return
+        self.enabled = True
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, embedding BLOB, response TEXT, created_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_namespace ON cache (namespace)")
+        self.conn.commit()
+
+    def get(self, namespace: str, prompt: str):
+        """Return the cached response for the most similar prompt, or None."""
+        if not self.enabled:
+            return None
+        self.conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self.conn.commit()
+        row = self.conn.execute(
+            "SELECT response, vec_distance_cosine(embedding, ?) AS dist FROM cache WHERE namespace = ? ORDER BY dist LIMIT 1",
+            (embed_to_blob(prompt), namespace),
+        ).fetchone()
+        if row is not None and (1.0 - row[1]) >= self.threshold:
+            return row[0]
+        return None
+
+    def put(self, namespace: str, prompt: str, response: str):
+        if not self.enabled:
+            return
+        self.conn.execute(
+            "INSERT INTO cache (namespace, embedding, response, created_at) VALUES (?, ?, ?, ?)",
+            (namespace, embed_to_blob(prompt), response, time.time()),
+        )
+        self.conn.commit()